@@ -2,109 +2,249 @@
 
 import logging # Keep this at the very top
 import os      # Keep this near the top for environment access
-import re      # For SecureFormatter and other regex operations
-
-# --- NEW: Secure Logging Formatter ---
-class SecureFormatter(logging.Formatter):
-    """Custom formatter that redacts sensitive data from log messages."""
-    
-    REDACTION_PATTERNS = [
-        # Gemini API Key (as query param: key=VALUE)
-        (re.compile(r'([?&]key=)[^&]+'), r'\1[REDACTED_GEMINI_KEY]'),
-        # Hugging Face Token (Authorization: Bearer TOKEN)
-        (re.compile(r'(Authorization\s*:\s*Bearer\s+)\S+'), r'\1[REDACTED_HF_TOKEN]'),
-        # Ultravox API Key (X-API-Key: KEY) - Less likely in logs but good to have
-        (re.compile(r'(X-API-Key\s*:\s*)\S+'), r'\1[REDACTED_ULTRAVOX_KEY]'),
-        # Generic "token": "value" or "api_key": "value" in JSON-like strings or assignments
-        (re.compile(r'("?(?:api_key|token|secret|password)"?\s*[:=]\s*"?)\S+("?)', re.IGNORECASE), r'\1[REDACTED_SENSITIVE_VALUE]\2'),
-    ]
-
-    def format(self, record):
-        # Get the original formatted message (handles record.msg % record.args)
-        message = super().format(record)
-        
-        for pattern, replacement in self.REDACTION_PATTERNS:
-            message = pattern.sub(replacement, message)
+import re      # For RedactFilter and other regex operations
+
+# Cheap substring triggers checked before any redaction regex runs. Lowercase so a
+# single lowercased copy of the message covers the case-insensitive JSON pattern too.
+REDACTION_TRIGGERS = ("key=", "bearer", "x-api-key", "api_key", "token", "secret", "password")
+
+_WHITESPACE = " \t\r\n"
+
+def _find_ws(msg: str, start: int) -> int:
+    """Return the index of the first whitespace char at or after start (len(msg) if none)."""
+    end = len(msg)
+    for ws in _WHITESPACE:
+        i = msg.find(ws, start, end)
+        if i != -1:
+            end = i
+    return end
+
+def _skip_ws(msg: str, i: int) -> int:
+    while i < len(msg) and msg[i] in _WHITESPACE:
+        i += 1
+    return i
+
+def _redact_query_key(msg: str) -> str:
+    """Gemini API Key (as query param: ?key=VALUE / &key=VALUE), value runs up to the next '&'."""
+    tag = "[REDACTED_GEMINI_KEY]"
+    i = msg.find("key=")
+    while i != -1:
+        start = i + 4
+        if i > 0 and msg[i - 1] in "?&":
+            end = msg.find("&", start)
+            if end == -1:
+                end = len(msg)
+            if end > start:
+                msg = msg[:start] + tag + msg[end:]
+                start += len(tag)
+        i = msg.find("key=", start)
+    return msg
+
+# Field names the X-API-Key and key/value redactions handle; "Bearer <name>:" is one of those, not a token.
+_LABEL_NAMES = frozenset({"x-api-key", "api_key", "token", "secret", "password"})
+
+def _follows_authorization(msg: str, i: int) -> bool:
+    """True if msg[:i] ends with "Authorization" and a colon, ignoring whitespace."""
+    j = i - 1
+    while j >= 0 and msg[j] in _WHITESPACE:
+        j -= 1
+    if j < 0 or msg[j] != ":":
+        return False
+    j -= 1
+    while j >= 0 and msg[j] in _WHITESPACE:
+        j -= 1
+    return msg.endswith("Authorization", 0, j + 1)
+
+def _is_label(msg: str, start: int, end: int) -> bool:
+    """True if msg[start:end] is a known field name followed by ':' ("token:", "X-API-Key :", "token:VALUE")."""
+    name, colon, _ = msg[start:end].partition(":")
+    if not colon and not msg.startswith(":", _skip_ws(msg, end)):
+        return False
+    return name.strip("\"'").lower() in _LABEL_NAMES
+
+def _redact_bearer(msg: str) -> str:
+    """Hugging Face Token (Authorization: Bearer TOKEN), "Bearer" followed by any whitespace."""
+    tag = "[REDACTED_HF_TOKEN]"
+    i = msg.find("Bearer")
+    while i != -1:
+        start = i + 6
+        if start < len(msg) and msg[start] in _WHITESPACE:
+            start = _skip_ws(msg, start)
+            end = _find_ws(msg, start)
+            # Right after "Authorization:" the next word is always the token. Elsewhere a following
+            # "X-API-Key:" / "token:" label is left for the other redactions to catch the value after it.
+            is_label = not _follows_authorization(msg, i) and _is_label(msg, start, end)
+            if end > start and not is_label:
+                msg = msg[:start] + tag + msg[end:]
+                start += len(tag)
+        i = msg.find("Bearer", start)
+    return msg
+
+def _redact_ultravox_key(msg: str) -> str:
+    """Ultravox API Key (X-API-Key: KEY) - Less likely in logs but good to have."""
+    tag = "[REDACTED_ULTRAVOX_KEY]"
+    i = msg.find("X-API-Key")
+    while i != -1:
+        start = _skip_ws(msg, i + 9)
+        if start < len(msg) and msg[start] == ":":
+            start = _skip_ws(msg, start + 1)
+            end = _find_ws(msg, start)
+            if end > start:
+                msg = msg[:start] + tag + msg[end:]
+                start += len(tag)
+        i = msg.find("X-API-Key", start)
+    return msg
+
+# --- NEW: Secure Logging Filter ---
+class RedactFilter(logging.Filter):
+    """Logging filter that redacts sensitive data from records before handlers format them."""
+
+    # Generic "token": "value" or "api_key": "value" in JSON-like strings or assignments.
+    # The other redactions have fixed case-sensitive prefixes and are spliced with str.find above.
+    KV_REDACTION_PATTERN = re.compile(r'("?(?:api_key|token|secret|password)"?\s*[:=]\s*"?)\S+', re.IGNORECASE)
+
+    # Used only to render tracebacks so they can be redacted before the handler's formatter sees them.
+    _exc_formatter = logging.Formatter()
+
+    def redact(self, message: str) -> str:
+        # Fast path: most messages contain none of the trigger substrings, so skip all redaction work.
+        msg_lower = message.lower()
+        if not any(trigger in msg_lower for trigger in REDACTION_TRIGGERS):
+            return message
+
+        message = _redact_query_key(message)
+        message = _redact_bearer(message)
+        message = _redact_ultravox_key(message)
+        # A trigger hit doesn't guarantee a key/value match; only rebind when something was replaced.
+        redacted, count = self.KV_REDACTION_PATTERN.subn(r'\1[REDACTED_SENSITIVE_VALUE]', message)
+        if count:
+            message = redacted
         return message
 
+    def filter(self, record):
+        # Render record.msg % record.args once and cache it on the record, so the formatter
+        # (and any further handler sharing this filter) doesn't format it again.
+        # Handler.filter() runs outside emit()'s error guard: on a malformed log call (bad args)
+        # leave the record untouched so the handler reports "--- Logging error ---" as usual
+        # instead of raising into the caller.
+        try:
+            message = self.redact(record.getMessage())
+        except Exception:
+            return True
+        record.msg = message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.redact(self._exc_formatter.formatException(record.exc_info))
+        if record.stack_info:
+            record.stack_info = self.redact(record.stack_info)
+        return True
+
 # Configure logging AT THE VERY TOP and set level to DEBUG
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# datefmt without %f skips the per-record millisecond formatting; Cloud Run stamps absolute times on ingest.
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S')
 
-# --- NEW: Apply SecureFormatter to root logger's handlers ---
-secure_formatter_instance = SecureFormatter(fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# --- NEW: Apply RedactFilter to root logger's handlers ---
+# Installed on the handlers rather than the root logger: logger-level filters are skipped for
+# records propagated from child loggers (httpx, httpcore, uvicorn, ...), handler filters are not.
+redact_filter_instance = RedactFilter()
 for handler in logging.root.handlers:
-    handler.setFormatter(secure_formatter_instance)
+    handler.addFilter(redact_filter_instance)
 # --- END NEW ---
 
+# The HTTP/2 stack logs raw header tuples at DEBUG (e.g. (b'x-api-key', b'...')), which the
+# redactions above don't parse. Keep it at INFO so upstream credentials never reach the log.
+for noisy_logger in ("hpack", "h2", "httpcore"):
+    logging.getLogger(noisy_logger).setLevel(logging.INFO)
+
 logger = logging.getLogger(__name__) # Get your specific logger
 
-logger.critical("########## main.py: SCRIPT EXECUTION STARTED (Top Level) ##########")
-
-try:
-    logger.critical("########## main.py: Attempting initial imports... ##########")
-    import json
-    # import re # Already imported above
-    import asyncio
-    import requests 
-    from typing import List # For type hinting validate_required_env_vars
-    import sys # For sys.exit in __main__
-    from fastapi import FastAPI, HTTPException, Request, Body
-    from fastapi.responses import JSONResponse 
-    from fastapi.middleware.cors import CORSMiddleware
-    logger.critical("########## main.py: Initial imports SUCCEEDED. ##########")
-except ImportError as e_import:
-    logger.critical(f"########## main.py: FATAL IMPORT ERROR: {e_import} ##########", exc_info=True)
-    raise # Re-raise to ensure Cloud Run sees the failure clearly
-
-logger.critical("########## main.py: Defining constants and configuration variables... ##########")
+import functools
+import orjson # Faster (de)serialization for the large AI #2 / AI #3 payloads and summaries
+import asyncio
+import httpx # Async client for the Ultravox, AI #2 and AI #3 calls
+from cachetools import TTLCache
+import msgspec # Fast decoding of fixed-shape request bodies
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List # For type hinting validate_local_env_vars
+import sys # For sys.exit in __main__
+import time
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from fastapi.middleware.cors import CORSMiddleware
 
 # --- Environment Variables & Configuration ---
 ULTRAVOX_API_KEY_ENV_VAR = "ULTRAVOX_API_KEY" 
-ULTRAVOX_AGENT_ID = os.environ.get("ULTRAVOX_AGENT_ID", "fb42f359-003c-4875-b1a1-06c4c1c87376")
-logger.critical(f"Attempted to load ULTRAVOX_AGENT_ID. Value: '{ULTRAVOX_AGENT_ID}' (Default was 'fb42f359-003c-4875-b1a1-06c4c1c87376')")
+ULTRAVOX_AGENT_ID_DEFAULT = "fb42f359-003c-4875-b1a1-06c4c1c87376"
 ULTRAVOX_API_BASE_URL = "https://api.ultravox.ai/api"
-logger.critical(f"ULTRAVOX_API_BASE_URL set to: {ULTRAVOX_API_BASE_URL}")
 
 GEMINI_API_KEY_ENV_VAR = "GEMINI_API_KEY"
 AI2_GEMINI_MODEL_NAME_DEFAULT = "gemini-2.5-flash-preview-05-20"
-AI2_GEMINI_MODEL_NAME = os.environ.get("AI2_GEMINI_MODEL_NAME", AI2_GEMINI_MODEL_NAME_DEFAULT) 
-logger.critical(f"Attempted to load AI2_GEMINI_MODEL_NAME. Value: '{AI2_GEMINI_MODEL_NAME}' (Default was '{AI2_GEMINI_MODEL_NAME_DEFAULT}')")
 GEMINI_API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
-logger.critical(f"GEMINI_API_BASE_URL set to: {GEMINI_API_BASE_URL}")
 
 HF_API_TOKEN_ENV_VAR = "HF_API_TOKEN"
 AI3_HF_ENDPOINT_URL_DEFAULT = "https://vvgxd2ms1kn7p2sq.us-east4.gcp.endpoints.huggingface.cloud"
-AI3_HF_ENDPOINT_URL = os.environ.get("AI3_HF_ENDPOINT_URL", AI3_HF_ENDPOINT_URL_DEFAULT)
-logger.critical(f"Attempted to load AI3_HF_ENDPOINT_URL. Value: '{AI3_HF_ENDPOINT_URL}' (Default was '{AI3_HF_ENDPOINT_URL_DEFAULT}')")
-
-logger.critical("########## main.py: Constants and configurations defined. ##########")
-logger.critical("########## main.py: Initializing FastAPI app object... ##########")
-app = FastAPI(title="AI Medical Intake Backend", version="1.2.4_secure_debug") # Updated version
-logger.critical("########## main.py: FastAPI app object INITIALIZED. ##########")
-
-# --- CORS Configuration (Agnostic & More Secure) ---
-logger.critical("########## main.py: Configuring CORS middleware... ##########")
-_env_allowed_origins = os.environ.get("ALLOWED_ORIGINS")
-if _env_allowed_origins: # If set to a non-empty string
-    ALLOWED_ORIGINS = [origin.strip() for origin in _env_allowed_origins.split(',') if origin.strip()]
-    if not ALLOWED_ORIGINS: # e.g., env_val was " , "
-        logger.warning(f"ALLOWED_ORIGINS environment variable ('{_env_allowed_origins}') "
-                       "was set but contained no valid origins after parsing. CORS will be highly restrictive (no origins allowed).")
-        ALLOWED_ORIGINS = [] # Explicitly allow no origins in this case
-    else:
-        logger.info(f"CORS: Using ALLOWED_ORIGINS from env var: {ALLOWED_ORIGINS}")
-else: # Not set, or set to empty string - use defaults
-    ALLOWED_ORIGINS = [
-        "http://localhost:3000", # Common frontend dev port
-        "http://localhost:8081", # Another common local dev port for frontend
-        "http://localhost:5173", # Vite default
-        # IMPORTANT: Add your actual frontend production/staging URLs here
-        # e.g., "https://your-app-frontend.your-domain.com"
-    ]
-    if _env_allowed_origins is None:
-        logger.info(f"CORS: ALLOWED_ORIGINS environment variable not set. Defaulting to: {ALLOWED_ORIGINS}")
-    else: # Was set to "" (empty string)
-        logger.info(f"CORS: ALLOWED_ORIGINS environment variable was empty. Defaulting to: {ALLOWED_ORIGINS}")
+
+DEFAULT_ALLOWED_ORIGINS = (
+    "http://localhost:3000", # Common frontend dev port
+    "http://localhost:8081", # Another common local dev port for frontend
+    "http://localhost:5173", # Vite default
+    # IMPORTANT: Add your actual frontend production/staging URLs here
+    # e.g., "https://your-app-frontend.your-domain.com"
+)
+
+@dataclass(frozen=True)
+class Config:
+    """Settings resolved from the environment once, at import time."""
+    ultravox_api_key: str | None
+    ultravox_agent_id: str
+    gemini_api_key: str | None
+    gemini_model_name: str
+    hf_api_token: str | None
+    hf_endpoint_url: str
+    allowed_origins: tuple[str, ...]
+
+def load_config() -> Config:
+    env = os.environ
+
+    for var_name, default in (
+        ("ULTRAVOX_AGENT_ID", ULTRAVOX_AGENT_ID_DEFAULT),
+        ("AI2_GEMINI_MODEL_NAME", AI2_GEMINI_MODEL_NAME_DEFAULT),
+        ("AI3_HF_ENDPOINT_URL", AI3_HF_ENDPOINT_URL_DEFAULT),
+    ):
+        if var_name not in env:
+            logger.warning("%s is using its default value '%s'. Ensure this is intended if an override was expected via env var.", var_name, default)
+
+    # --- CORS Configuration (Agnostic & More Secure) ---
+    raw_origins = env.get("ALLOWED_ORIGINS")
+    if raw_origins: # If set to a non-empty string
+        allowed_origins = tuple(origin.strip() for origin in raw_origins.split(',') if origin.strip())
+        if not allowed_origins: # e.g., env_val was " , "
+            logger.warning("ALLOWED_ORIGINS environment variable ('%s') was set but contained no valid origins after parsing. "
+                           "CORS will be highly restrictive (no origins allowed).", raw_origins)
+    else: # Not set, or set to empty string - use defaults
+        allowed_origins = DEFAULT_ALLOWED_ORIGINS
+
+    return Config(
+        ultravox_api_key=env.get(ULTRAVOX_API_KEY_ENV_VAR),
+        ultravox_agent_id=env.get("ULTRAVOX_AGENT_ID", ULTRAVOX_AGENT_ID_DEFAULT),
+        gemini_api_key=env.get(GEMINI_API_KEY_ENV_VAR),
+        gemini_model_name=env.get("AI2_GEMINI_MODEL_NAME", AI2_GEMINI_MODEL_NAME_DEFAULT),
+        hf_api_token=env.get(HF_API_TOKEN_ENV_VAR),
+        hf_endpoint_url=env.get("AI3_HF_ENDPOINT_URL", AI3_HF_ENDPOINT_URL_DEFAULT),
+        allowed_origins=allowed_origins,
+    )
+
+CONFIG = load_config()
+ULTRAVOX_AGENT_ID = CONFIG.ultravox_agent_id
+AI2_GEMINI_MODEL_NAME = CONFIG.gemini_model_name
+AI3_HF_ENDPOINT_URL = CONFIG.hf_endpoint_url
+ALLOWED_ORIGINS = list(CONFIG.allowed_origins)
+logger.info("startup config: ultravox_agent=%s gemini_model=%s hf_endpoint=%s allowed_origins=%s",
+            ULTRAVOX_AGENT_ID, AI2_GEMINI_MODEL_NAME, AI3_HF_ENDPOINT_URL, ALLOWED_ORIGINS)
+
+# ORJSONResponse: endpoint return values (multi-KB AI analysis text) are serialized with orjson
+app = FastAPI(title="AI Medical Intake Backend", version="1.2.4_secure_debug", default_response_class=ORJSONResponse) # Updated version
 
 app.add_middleware(
     CORSMiddleware,
@@ -113,74 +253,99 @@ app.add_middleware(
     allow_methods=["GET", "POST"],   # Specific methods
     allow_headers=["Content-Type", "Authorization", "X-Request-ID"], # Specific headers
 )
-logger.critical(f"########## main.py: CORS middleware CONFIGURED. Allowed Origins: {ALLOWED_ORIGINS} ##########")
 
 
-# --- Global Variables (to hold loaded keys/configs) ---
-logger.critical("########## main.py: Initializing global key/config holders to None... ##########")
+# --- Global Variables (to hold keys/configs validated at startup) ---
 ULTRAVOX_API_KEY_VALUE = None
 GEMINI_API_KEY_VALUE = None
-HF_API_TOKEN_VALUE = None
-AI3_HF_ENDPOINT_URL_VALUE = None
+# HF caller built by startup_event from the validated config; None (503 from AI #3) until then.
+call_hf_inference_api = None
 
 # --- QUICK FIX: Call management to prevent 4409 conflicts ---
-call_cooldown = {}  # Simple in-memory cooldown tracking
-
-logger.critical("########## main.py: Global key/config holders INITIALIZED. ##########")
+# One call per 5s per caller (rate 0.2 tokens/s, burst of 1).
+CALL_RATE_PER_SECOND = 0.2
+CALL_BURST = 1
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens/second, holding at most `cap` tokens."""
+    __slots__ = ("tokens", "last", "rate", "cap")
+
+    def __init__(self, rate: float, cap: float, now: float):
+        self.tokens = cap
+        self.last = now
+        self.rate = rate
+        self.cap = cap
+
+    def acquire(self, now: float) -> bool:
+        # Synchronous on purpose: with no await between refill and take, it is atomic on the event loop.
+        self.tokens = min(self.cap, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self) -> None:
+        # Give back the token taken by acquire() when the call it paid for never happened.
+        self.tokens = min(self.cap, self.tokens + 1)
+
+# Buckets keyed by client host. A bucket idle for 60s has long refilled, so letting the TTL evict it
+# is equivalent to keeping it; maxsize caps memory. The TTL and the bucket refill both run on
+# time.monotonic(), so wall-clock jumps (NTP corrections, container clock sync) can't skew either.
+call_buckets = TTLCache(maxsize=10_000, ttl=60, timer=time.monotonic)
 
 
 # --- FastAPI Event Handlers ---
 @app.on_event("startup")
 async def startup_event():
-    logger.critical("########## main.py @app.on_event('startup'): EXECUTION STARTED ##########")
-    global ULTRAVOX_API_KEY_VALUE, GEMINI_API_KEY_VALUE, HF_API_TOKEN_VALUE, AI3_HF_ENDPOINT_URL_VALUE
-
-    logger.critical(f"STARTUP: Attempting to load env var: {ULTRAVOX_API_KEY_ENV_VAR}")
-    ULTRAVOX_API_KEY_VALUE = os.environ.get(ULTRAVOX_API_KEY_ENV_VAR)
-    if not ULTRAVOX_API_KEY_VALUE:
-        err_msg = f"❌ CRITICAL STARTUP FAILURE: Required environment variable '{ULTRAVOX_API_KEY_ENV_VAR}' is not set or is empty."
+    global ULTRAVOX_API_KEY_VALUE, GEMINI_API_KEY_VALUE, call_hf_inference_api
+
+    for env_var, value in (
+        (ULTRAVOX_API_KEY_ENV_VAR, CONFIG.ultravox_api_key),
+        (GEMINI_API_KEY_ENV_VAR, CONFIG.gemini_api_key),
+        (HF_API_TOKEN_ENV_VAR, CONFIG.hf_api_token),
+    ):
+        if not value:
+            err_msg = f"❌ CRITICAL STARTUP FAILURE: Required environment variable '{env_var}' is not set or is empty."
+            logger.critical(err_msg)
+            raise RuntimeError(err_msg)
+    if not CONFIG.hf_endpoint_url: # Simpler check, rely on default if env var not set for URL
+        err_msg = "❌ CRITICAL STARTUP FAILURE: AI3_HF_ENDPOINT_URL resolved to an empty value. Env var 'AI3_HF_ENDPOINT_URL' might be empty or default is problematic."
         logger.critical(err_msg)
         raise RuntimeError(err_msg)
-    logger.critical(f"STARTUP: Successfully loaded {ULTRAVOX_API_KEY_ENV_VAR}. (Value Redacted from log by SecureFormatter if pattern matches)")
 
-    logger.critical(f"STARTUP: Attempting to load env var: {GEMINI_API_KEY_ENV_VAR}")
-    GEMINI_API_KEY_VALUE = os.environ.get(GEMINI_API_KEY_ENV_VAR)
-    if not GEMINI_API_KEY_VALUE:
-        err_msg = f"❌ CRITICAL STARTUP FAILURE: Required environment variable '{GEMINI_API_KEY_ENV_VAR}' is not set or is empty."
-        logger.critical(err_msg)
-        raise RuntimeError(err_msg)
-    logger.critical(f"STARTUP: Successfully loaded {GEMINI_API_KEY_ENV_VAR}. (Value Redacted from log by SecureFormatter if pattern matches)")
+    ULTRAVOX_API_KEY_VALUE = CONFIG.ultravox_api_key
+    GEMINI_API_KEY_VALUE = CONFIG.gemini_api_key
 
-    logger.critical(f"STARTUP: Attempting to load env var: {HF_API_TOKEN_ENV_VAR}")
-    HF_API_TOKEN_VALUE = os.environ.get(HF_API_TOKEN_ENV_VAR)
-    if not HF_API_TOKEN_VALUE:
-        err_msg = f"❌ CRITICAL STARTUP FAILURE: Required environment variable '{HF_API_TOKEN_ENV_VAR}' is not set or is empty."
-        logger.critical(err_msg)
-        raise RuntimeError(err_msg)
-    logger.critical(f"STARTUP: Successfully loaded {HF_API_TOKEN_ENV_VAR}. (Value Redacted from log by SecureFormatter if pattern matches)")
-    
-    logger.critical(f"STARTUP: Attempting to load env var: AI3_HF_ENDPOINT_URL (from global AI3_HF_ENDPOINT_URL)")
-    AI3_HF_ENDPOINT_URL_VALUE = AI3_HF_ENDPOINT_URL 
-    if not AI3_HF_ENDPOINT_URL_VALUE: # Simpler check, rely on default if env var not set for URL
-         err_msg = f"❌ CRITICAL STARTUP FAILURE: AI3_HF_ENDPOINT_URL resolved to an empty value. Env var 'AI3_HF_ENDPOINT_URL' might be empty or default is problematic."
-         logger.critical(err_msg)
-         raise RuntimeError(err_msg)
-    # Warning for default URL if actual env var was missing (original logic was a bit complex here, simplified)
-    if AI3_HF_ENDPOINT_URL_VALUE == AI3_HF_ENDPOINT_URL_DEFAULT and not os.environ.get("AI3_HF_ENDPOINT_URL"):
-        logger.warning(f"STARTUP: AI3_HF_ENDPOINT_URL is using its default value '{AI3_HF_ENDPOINT_URL_DEFAULT}'. Ensure this is intended if an override was expected via env var.")
-    logger.critical(f"STARTUP: AI #3 Hugging Face Endpoint URL confirmed: '{AI3_HF_ENDPOINT_URL_VALUE}'")
-    
-    logger.critical(f"STARTUP: AI #2 (Summarization) will use Gemini model: '{AI2_GEMINI_MODEL_NAME}'")
-    if AI2_GEMINI_MODEL_NAME == AI2_GEMINI_MODEL_NAME_DEFAULT and not os.environ.get("AI2_GEMINI_MODEL_NAME"):
-        logger.warning(f"STARTUP: AI2_GEMINI_MODEL_NAME is using its default value '{AI2_GEMINI_MODEL_NAME_DEFAULT}'. Ensure this is intended if an override was expected via env var.")
+    # The model and key are fixed for the process lifetime, so build the Gemini URL once.
+    app.state.gemini_url, app.state.gemini_url_log = _gemini_urls(AI2_GEMINI_MODEL_NAME.replace("models/", ""))
 
-    logger.critical(f"STARTUP: Ultravox Agent ID configured: '{ULTRAVOX_AGENT_ID}'")
-    if ULTRAVOX_AGENT_ID == "fb42f359-003c-4875-b1a1-06c4c1c87376" and not os.environ.get("ULTRAVOX_AGENT_ID"): # Default UUID
-        logger.warning(f"STARTUP: ULTRAVOX_AGENT_ID is using its default value. Ensure this is intended if an override was expected via env var.")
+    # Shared async HTTP client: keep-alive + HTTP/2 so Ultravox/Gemini/HF calls reuse pooled connections
+    # on the event loop instead of a fresh TCP+TLS handshake on an executor thread per call.
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(180.0, connect=10.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    )
+    # HF endpoint URL, token and client are captured as closure cells instead of module globals.
+    call_hf_inference_api = _make_hf_caller(CONFIG.hf_endpoint_url, CONFIG.hf_api_token, app.state.http)
 
-    logger.critical("########## main.py @app.on_event('startup'): EXECUTION COMPLETED SUCCESSFULLY ##########")
+    logger.debug("startup_event completed successfully")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    http_client = getattr(app.state, "http", None)
+    if http_client is not None:
+        await http_client.aclose()
 
 # --- Helper Function for Gemini API call (AI #2) ---
+def _gemini_urls(effective_model_name: str) -> tuple[str, str]:
+    """Return (request URL, key-free URL for logging) for a Gemini model."""
+    # streamGenerateContent with alt=sse emits the generation as server-sent events, so chunks are
+    # parsed as they arrive instead of after the whole body has been buffered.
+    log_url = f"{GEMINI_API_BASE_URL}/{effective_model_name}:streamGenerateContent"
+    return f"{log_url}?alt=sse&key={GEMINI_API_KEY_VALUE}", log_url
+
 async def call_gemini_api(
     model_name: str, 
     prompt: str, 
@@ -194,8 +359,10 @@ async def call_gemini_api(
         raise HTTPException(status_code=503, detail="Gemini AI service is not configured (API key missing at call time).")
 
     effective_model_name = model_name.replace("models/", "") 
-    # The API key in the URL will be redacted by SecureFormatter if logged
-    api_url = f"{GEMINI_API_BASE_URL}/{effective_model_name}:generateContent?key={GEMINI_API_KEY_VALUE}"
+    if model_name == AI2_GEMINI_MODEL_NAME:
+        api_url, log_url = app.state.gemini_url, app.state.gemini_url_log # Resolved once in startup_event
+    else:
+        api_url, log_url = _gemini_urls(effective_model_name)
     
     headers = {"Content-Type": "application/json"}
     payload = {
@@ -207,49 +374,56 @@ async def call_gemini_api(
             "topK": top_k,
         }
     }
-    # Logged URL will have key redacted by SecureFormatter
-    logger.info(f"Calling Gemini API with model: {effective_model_name} at URL (key redacted in logs): {api_url}")
+    # Log the key-free URL so this line never needs redaction
+    logger.info(f"Calling Gemini API with model: {effective_model_name} at URL (key omitted in logs): {log_url}")
     try:
-        loop = asyncio.get_event_loop()
+        text_parts = []
+        last_chunk = None
+        finish_reason = None
+        prompt_feedback = {}
         # Timeout increased to 180s as per previous version
-        response = await loop.run_in_executor(None, lambda: requests.post(api_url, headers=headers, json=payload, timeout=180))
-        response.raise_for_status()
-        result = response.json()
-        if (result.get("candidates") and isinstance(result["candidates"], list) and 
-            len(result["candidates"]) > 0 and result["candidates"][0].get("content") and
-            result["candidates"][0]["content"].get("parts") and 
-            isinstance(result["candidates"][0]["content"]["parts"], list) and
-            len(result["candidates"][0]["content"]["parts"]) > 0 and
-            "text" in result["candidates"][0]["content"]["parts"][0]):
-            return result["candidates"][0]["content"]["parts"][0]["text"]
-        if result.get("candidates") and result["candidates"][0].get("finishReason") != "STOP":
-            finish_reason = result['candidates'][0].get('finishReason')
-            logger.warning(f"Gemini generation for {effective_model_name} finished with reason: {finish_reason}.")
-            if result.get("promptFeedback", {}).get("blockReason"):
-                block_reason = result['promptFeedback']['blockReason']
-                safety_ratings = result['promptFeedback'].get('safetyRatings')
-                logger.error(f"Gemini prompt for {effective_model_name} blocked. Reason: {block_reason}. Ratings: {safety_ratings}")
-                raise HTTPException(status_code=400, detail=f"Request blocked by AI safety filters: {block_reason}")
-            if finish_reason == "MAX_TOKENS" and result["candidates"][0].get("content", {}).get("parts",[{}])[0].get("text"):
-                 return result["candidates"][0]["content"]["parts"][0]["text"] 
+        async with app.state.http.stream("POST", api_url, headers=headers, content=orjson.dumps(payload), timeout=180) as response:
+            if response.is_error:
+                await response.aread() # Buffer the error body so the HTTPStatusError handler below can read it
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                last_chunk = orjson.loads(line[5:])
+                prompt_feedback = last_chunk.get("promptFeedback") or prompt_feedback
+                # Happy path first (EAFP): each chunk carries the next slice of the first candidate's text.
+                try:
+                    candidate = last_chunk["candidates"][0]
+                    finish_reason = candidate.get("finishReason") or finish_reason
+                    text_parts.append(candidate["content"]["parts"][0]["text"])
+                except (KeyError, IndexError, TypeError, AttributeError):
+                    pass
+        if text_parts:
+            return "".join(text_parts)
+        if prompt_feedback.get("blockReason"):
+            block_reason = prompt_feedback['blockReason']
+            safety_ratings = prompt_feedback.get('safetyRatings')
+            logger.error(f"Gemini prompt for {effective_model_name} blocked. Reason: {block_reason}. Ratings: {safety_ratings}")
+            raise HTTPException(status_code=400, detail=f"Request blocked by AI safety filters: {block_reason}")
+        if finish_reason and finish_reason != "STOP":
             logger.warning(f"Gemini generation for {effective_model_name} resulted in finish reason '{finish_reason}' but no text content was found in the expected place.")
             return "" # Return empty string if no usable content
-        logger.error(f"Could not parse Gemini response or unexpected format for {effective_model_name}: {json.dumps(result, indent=2)}")
+        logger.error(f"Could not parse Gemini response or unexpected format for {effective_model_name}: {orjson.dumps(last_chunk, option=orjson.OPT_INDENT_2).decode()}")
         raise HTTPException(status_code=502, detail="Invalid response format from Gemini AI service.")
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         logger.error(f"Timeout calling Gemini API for model {effective_model_name}")
         raise HTTPException(status_code=504, detail="Gemini AI service timeout.")
-    except requests.exceptions.RequestException as e:
-        # Exception string (e) might contain the URL with API key, SecureFormatter will handle redaction in logs.
+    except httpx.HTTPError as e:
+        # Exception string (e) might contain the URL with API key, RedactFilter will handle redaction in logs.
         logger.error(f"Error calling Gemini API for model {effective_model_name}: {e}")
         detail_msg = f"Error communicating with Gemini AI service: {str(e)[:200]}..." # Truncate potentially long error
         status_code = 502 
-        if e.response is not None:
+        if isinstance(e, httpx.HTTPStatusError):
             status_code = e.response.status_code
             try:
-                error_content = e.response.json()
-                # error_content itself might contain sensitive info if API echoes it; SecureFormatter helps if logged raw
-                logger.error(f"Gemini API error details: {json.dumps(error_content)}") # Log the JSON error
+                error_content = orjson.loads(e.response.content)
+                # error_content itself might contain sensitive info if API echoes it; RedactFilter helps if logged raw
+                logger.error(f"Gemini API error details: {orjson.dumps(error_content).decode()}") # Log the JSON error
                 detail_msg = error_content.get("error", {}).get("message", e.response.text)
             except ValueError: 
                 detail_msg = e.response.text
@@ -259,172 +433,131 @@ async def call_gemini_api(
         raise HTTPException(status_code=status_code, detail=detail_msg)
 
 # --- Helper Function for Hugging Face API call (AI #3) ---
-async def call_hf_inference_api(
-    prompt: str, 
-    temperature: float = 0.6, 
-    max_new_tokens: int = 700,
-    top_p: float = 0.9,
-    do_sample: bool = True
-    ) -> str:
-    if not AI3_HF_ENDPOINT_URL_VALUE or not HF_API_TOKEN_VALUE:
-        logger.error("Hugging Face Inference API URL or Token is not configured (global value missing).")
-        raise HTTPException(status_code=503, detail="HF Inference service is not configured (config missing at call time).")
-
-    # Authorization header value will be redacted by SecureFormatter if logged
+def _make_hf_caller(url: str, token: str, client: httpx.AsyncClient):
+    """Build call_hf_inference_api bound to the endpoint, token and HTTP client validated at startup."""
+    # Authorization header value will be redacted by RedactFilter if logged
     headers = {
-        "Authorization": f"Bearer {HF_API_TOKEN_VALUE}",
+        "Authorization": f"Bearer {token}",
         "Content-Type": "application/json"
     }
-    payload = {
-        "inputs": prompt,
-        "parameters": {
-            "max_new_tokens": max_new_tokens,
-            "temperature": temperature,
-            "top_p": top_p,
-            "do_sample": do_sample,
-            "return_full_text": False 
+
+    async def call_hf_inference_api(
+        prompt: str, 
+        temperature: float = 0.6, 
+        max_new_tokens: int = 700,
+        top_p: float = 0.9,
+        do_sample: bool = True
+        ) -> str:
+        payload = {
+            "inputs": prompt,
+            "parameters": {
+                "max_new_tokens": max_new_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "do_sample": do_sample,
+                "return_full_text": False 
+            }
         }
-    }
-    logger.info(f"Calling Hugging Face Inference API at {AI3_HF_ENDPOINT_URL_VALUE}")
+        logger.info(f"Calling Hugging Face Inference API at {url}")
+        try:
+            # Timeout 120s
+            response = await client.post(url, headers=headers, content=orjson.dumps(payload), timeout=120)
+            response.raise_for_status()
+            result = orjson.loads(response.content)
+            if result and isinstance(result, list) and 'generated_text' in result[0]:
+                return result[0]['generated_text']
+            logger.error(f"Could not parse HF Inference API response or unexpected format: {result}")
+            raise HTTPException(status_code=502, detail="Invalid response format from HF Inference service.")
+        except httpx.TimeoutException:
+            logger.error(f"Timeout calling HF Inference API: {url}")
+            raise HTTPException(status_code=504, detail="HF Inference service timeout.")
+        except httpx.HTTPError as e:
+            # Exception string (e) might contain headers, RedactFilter will handle redaction in logs.
+            logger.error(f"Error calling HF Inference API: {e}")
+            detail_msg = f"Error communicating with HF Inference service: {str(e)[:200]}..." # Truncate
+            status_code = 502
+            if isinstance(e, httpx.HTTPStatusError):
+                status_code = e.response.status_code
+                try:
+                    detail_msg_json = orjson.loads(e.response.content)
+                    logger.error(f"HF API error details: {orjson.dumps(detail_msg_json).decode()}")
+                    # Try to extract a meaningful message, be careful not to make detail_msg itself a huge JSON
+                    if isinstance(detail_msg_json, dict) and "error" in detail_msg_json:
+                        detail_msg = str(detail_msg_json["error"])
+                    else:
+                        detail_msg = e.response.text[:200] + "..." # Truncate if it's not a simple error string
+                except ValueError:
+                    detail_msg = e.response.text[:200] + "..." # Truncate
+            raise HTTPException(status_code=status_code, detail=detail_msg)
+
+    return call_hf_inference_api
+
+async def _warm_hf_connection(client: httpx.AsyncClient, url: str) -> None:
+    """Establish a pooled connection to the HF endpoint ahead of the AI #3 call; the response itself is irrelevant."""
     try:
-        loop = asyncio.get_event_loop()
-        # Timeout 120s
-        response = await loop.run_in_executor(None, lambda: requests.post(AI3_HF_ENDPOINT_URL_VALUE, headers=headers, json=payload, timeout=120))
-        response.raise_for_status()
-        result = response.json()
-        if result and isinstance(result, list) and 'generated_text' in result[0]:
-            return result[0]['generated_text']
-        logger.error(f"Could not parse HF Inference API response or unexpected format: {result}")
-        raise HTTPException(status_code=502, detail="Invalid response format from HF Inference service.")
-    except requests.exceptions.Timeout:
-        logger.error(f"Timeout calling HF Inference API: {AI3_HF_ENDPOINT_URL_VALUE}")
-        raise HTTPException(status_code=504, detail="HF Inference service timeout.")
-    except requests.exceptions.RequestException as e:
-        # Exception string (e) might contain headers, SecureFormatter will handle redaction in logs.
-        logger.error(f"Error calling HF Inference API: {e}")
-        detail_msg = f"Error communicating with HF Inference service: {str(e)[:200]}..." # Truncate
-        status_code = 502
-        if e.response is not None:
-            status_code = e.response.status_code
-            try:
-                detail_msg_json = e.response.json() 
-                logger.error(f"HF API error details: {json.dumps(detail_msg_json)}")
-                # Try to extract a meaningful message, be careful not to make detail_msg itself a huge JSON
-                if isinstance(detail_msg_json, dict) and "error" in detail_msg_json:
-                    detail_msg = str(detail_msg_json["error"])
-                else:
-                    detail_msg = e.response.text[:200] + "..." # Truncate if it's not a simple error string
-            except ValueError:
-                detail_msg = e.response.text[:200] + "..." # Truncate
-        raise HTTPException(status_code=status_code, detail=detail_msg)
+        await client.head(url, timeout=10)
+    except httpx.HTTPError as e:
+        logger.debug("HF connection warm-up failed (ignored): %s", e)
 
 # --- Prompts and Helper Functions (Content unchanged from previous correct version) ---
-AI2_SUMMARIZATION_SYSTEM_PROMPT = """## 1. CORE IDENTITY & PRIME DIRECTIVE
-
-You are an AI Medical Summarization Specialist. Your **sole and primary mission** is to process a transcript of a patient medical intake interview and generate a single, clean, and structured **JSON object** containing a comprehensive summary. This JSON summary is for review by a clinical team and for programmatic input into other analytical systems. You must adhere strictly to the provided JSON output format and content guidelines.
-
----
-
-## 2. INPUT SPECIFICATION
-
-You will receive a text transcript of a medical intake interview conducted by a conversational AI assistant with a patient. The transcript will contain:
-*   The AI assistant's questions and statements.
-*   The patient's responses and statements.
-*   Potentially, system notes or indicators within the transcript (e.g., `[PATIENT REQUESTED TO STOP INTERVIEW]`, `[EMERGENCY PROTOCOL ACTIVATED: REASON - CHEST PAIN]`). Pay attention to these as they may indicate an incomplete interview.
-
----
-
-## 3. TASK: SUMMARIZATION & JSON OUTPUT FORMAT
-
-Your task is to extract all relevant medical information from the provided transcript and organize it into a **single JSON object**.
-
-If information for a specific section was not discussed or is not present in the transcript, use `null` or an empty string `""` for the corresponding JSON field value. Do not infer or invent information.
-
-**Your final output MUST be a single JSON object structured as follows:**
-
-{
-  "chiefComplaint": "String or null",
-  "historyOfPresentIllness": "String or null",
-  "associatedSymptoms": "String or null",
-  "pastMedicalHistory": "String or null",
-  "medications": "String or null",
-  "allergies": "String or null",
-  "notesOnInteraction": "String or null"
-}
-
-**3.1. CONTENT GUIDELINES FOR EACH JSON FIELD:**
-
-*   `chiefComplaint`:
-    *   Extract the main reason(s) the patient is seeking care. (e.g., "Right knee pain and swelling")
-    *   If not explicitly stated or interview terminated early: "Information not gathered." or state what was clearly implied before termination.
-
-*   `historyOfPresentIllness`:
-    *   Provide a detailed, chronological narrative paragraph summarizing the patient's current medical complaint. This should synthesize answers related to Location, Onset, Character, Associated Symptoms (those directly related to the chief complaint), Timing/Triggers, Exacerbating/Alleviating Factors, and Severity (LOCATES framework). (e.g., "The patient is a 45-year-old male presenting with a 2-day history of sharp pain in the right knee, which reportedly began after a fall from a bicycle. The pain is rated by the patient as 7/10 and is described as exacerbated by weight-bearing activities such as walking. Partial alleviation is reported with the application of ice...")
-    *   If the interview was terminated early, summarize only what was obtained. (e.g., "Patient reported right knee pain. Onset was stated as two days prior, following a fall. Character of pain was described as sharp. Further details regarding associated symptoms, timing, exacerbating/alleviating factors, and severity were not obtained due to early termination of the interview.")
-
-*   `associatedSymptoms`:
-    *   List any other symptoms the patient mentioned that are not already detailed as part of the HPI narrative. (e.g., "Fever, chills.")
-    *   If none reported or not gathered: "None reported by patient." or "Information not gathered."
-    *   This section is for symptoms that might be secondary or not directly tied to the HPI's LOCATES elements but still relevant.
-
-*   `pastMedicalHistory`:
-    *   List any pre-existing medical conditions mentioned by the patient. (e.g., "Diabetes Type 2, Asthma.")
-    *   If none reported or not gathered: "None reported by patient." or "Information not gathered."
-
-*   `medications`:
-    *   List all medications the patient reported taking, including over-the-counter drugs and supplements. Include dosages and frequency if provided. (e.g., "Metformin 500mg BID. Albuterol inhaler PRN.")
-    *   If none reported or not gathered: "None reported by patient." or "Information not gathered."
-
-*   `allergies`:
-    *   List any drug, food, or environmental allergies mentioned by the patient, including the reaction if provided. (e.g., "Sulfa drugs (anaphylaxis), Peanuts (hives).")
-    *   If none reported or not gathered: "No known drug allergies reported by patient." or "Information not gathered."
-
-*   `notesOnInteraction` (If applicable):
-    *   If the transcript indicates the interview was terminated early by patient request, or if an emergency protocol was invoked, provide a brief, factual note here. (e.g., "Interview terminated by patient request after discussing the HPI." or "Emergency protocol was invoked by the conversational AI due to the patient reporting [specific symptom like 'crushing chest pain']. Patient advised to call 911. No further history obtained.")
-    *   If the interview completed normally without incident, this can be `null` or an empty string.
-
----
-
-## 4. CRITICAL GUIDELINES FOR SUMMARIZATION
-
-*   Objectivity: Report only what is stated in the transcript. Do not add interpretations or assumptions.
-*   Accuracy: Ensure the summary accurately reflects the information provided by the patient.
-*   Completeness (within transcript limits): Extract all relevant details for each section from the provided transcript.
-*   Conciseness: Be direct and avoid unnecessary jargon or overly verbose phrasing, while still being comprehensive.
-*   No Medical Advice or Diagnosis: Your role is to summarize, not to analyze or diagnose.
-*   Strict Adherence to Format: The output MUST be a single JSON object structured exactly as specified.
+@functools.cache
+def _ai2_prompt() -> str:
+    """AI #2 summarization system prompt, read from disk on first use instead of living in module memory."""
+    return Path(__file__).parent.joinpath("prompts/ai2_summary.md").read_text(encoding="utf-8")
+
+@functools.cache
+def _ai2_prompt_prefix() -> str:
+    """Static part of the AI #2 request placed before the transcript."""
+    return _ai2_prompt() + "\n\nTranscript:\n"
+
+_AI2_PROMPT_SUFFIX = (
+    "\n\n"
+    "IMPORTANT REMINDER: Your entire response MUST be a single, valid JSON object. "
+    "Do not include any other text, explanations, or markdown formatting like ```json ... ```. "
+    "Only the raw JSON object is permitted."
+)
 
----
-"""
+# Placeholder values AI #2 emits for fields it could not fill (see the summarization prompt guidelines).
+_NONINFO_PHRASES = frozenset({
+    "information not gathered",
+    "none reported",
+    "none reported by patient",
+    "no known drug allergies reported",
+    "no known drug allergies reported by patient",
+})
+# Longer values can't be a placeholder, so skip lowercasing them (the HPI narrative can be several KB).
+_NONINFO_MAX_LEN = max(map(len, _NONINFO_PHRASES)) + 2
+
+def _is_informative(value: str) -> bool:
+    # Expects an already-stripped value. Match the whole value, not a prefix: "None reported,
+    # but takes aspirin daily" is real data.
+    if not value:
+        return False
+    if len(value) > _NONINFO_MAX_LEN:
+        return True
+    return value.lower().rstrip(".!;, ") not in _NONINFO_PHRASES
+
+# (prompt label, AI #2 summary JSON key) for each field forwarded to AI #3, in prompt order.
+_ANALYSIS_FIELDS = (
+    ("Chief Complaint", "chiefComplaint"),
+    ("History of Present Illness", "historyOfPresentIllness"),
+    ("Associated Symptoms", "associatedSymptoms"),
+    ("Past Medical History", "pastMedicalHistory"),
+    ("Current Medications", "medications"),
+    ("Allergies", "allergies"),
+)
 
-def prepare_analysis_prompt(summary_json_string: str) -> str | None:
-    try:
-        data = json.loads(summary_json_string)
-    except json.JSONDecodeError:
-        logger.error("Error: Invalid JSON input to prepare_analysis_prompt.")
+def prepare_analysis_prompt(summary: dict) -> str | None:
+    # Takes the already-parsed AI #2 summary, so the caller doesn't re-encode it just to be decoded here.
+    if not isinstance(summary, dict):
+        logger.error("Error: AI #2 summary passed to prepare_analysis_prompt is not a JSON object.")
         return None
-    chief_complaint = data.get("chiefComplaint", "") or ""
-    hpi = data.get("historyOfPresentIllness", "") or ""
-    associated_symptoms = data.get("associatedSymptoms", "") or ""
-    past_medical_history = data.get("pastMedicalHistory", "") or ""
-    medications = data.get("medications", "") or ""
-    allergies = data.get("allergies", "") or ""
 
     patient_summary_parts = []
-    non_informative_phrases = {"information not gathered", "none reported", "none reported by patient", "no known drug allergies reported", "no known drug allergies reported by patient", ""}
-    
-    if chief_complaint and chief_complaint.lower() not in non_informative_phrases:
-        patient_summary_parts.append(f"Chief Complaint: {chief_complaint}")
-    if hpi and hpi.lower() not in non_informative_phrases:
-        patient_summary_parts.append(f"History of Present Illness: {hpi}")
-    if associated_symptoms and associated_symptoms.lower() not in non_informative_phrases:
-        patient_summary_parts.append(f"Associated Symptoms: {associated_symptoms}")
-    if past_medical_history and past_medical_history.lower() not in non_informative_phrases:
-        patient_summary_parts.append(f"Past Medical History: {past_medical_history}")
-    if medications and medications.lower() not in non_informative_phrases:
-        patient_summary_parts.append(f"Current Medications: {medications}")
-    if allergies and allergies.lower() not in non_informative_phrases:
-        patient_summary_parts.append(f"Allergies: {allergies}")
+    for label, key in _ANALYSIS_FIELDS:
+        value = (summary.get(key) or "").strip()
+        if _is_informative(value):
+            patient_summary_parts.append(f"{label}: {value}")
     
     patient_summary_for_analysis = "\n".join(patient_summary_parts)
 
@@ -456,32 +589,53 @@ Begin your analysis now.
 """
     return analysis_prompt
 
+def _compile_tag_patterns(tag_name: str) -> tuple[re.Pattern, ...]:
+    # Patterns are case-insensitive, so uppercase/capitalized tag variants are already covered.
+    tag = re.escape(tag_name)
+    return (
+        re.compile(rf'<{tag}>(.*?)</{tag}>', re.DOTALL | re.IGNORECASE),  # Standard format
+        re.compile(rf'<{tag}\s*>(.*?)</{tag}\s*>', re.DOTALL | re.IGNORECASE),  # With spaces
+    )
+
+# Compiled tag-extraction patterns, keyed by tag name; unknown tags are compiled and cached on first use.
+_TAG_RES = {"answer": _compile_tag_patterns("answer")}
+
+# AI #2 response cleanup: markdown code fences (with or without a language tag).
+_JSON_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$', re.MULTILINE | re.DOTALL)
+
 def extract_answer_from_tags(text_with_tags: str, tag_name: str = "answer") -> str | None:
     logger.info(f"[extract_answer_from_tags] Input text length: {len(text_with_tags)}")
     logger.info(f"[extract_answer_from_tags] Input text preview: {text_with_tags[:200]}...")
     
     # Try multiple patterns to be more flexible
-    patterns = [
-        rf'<{tag_name}>(.*?)</{tag_name}>',  # Standard format
-        rf'<{tag_name}\s*>(.*?)</{tag_name}\s*>',  # With spaces
-        rf'<{tag_name.upper()}>(.*?)</{tag_name.upper()}>',  # Uppercase
-        rf'<{tag_name.capitalize()}>(.*?)</{tag_name.capitalize()}>',  # Capitalized
-    ]
+    patterns = _TAG_RES.get(tag_name)
+    if patterns is None:
+        patterns = _TAG_RES[tag_name] = _compile_tag_patterns(tag_name)
     
     for pattern in patterns:
-        match = re.search(pattern, text_with_tags, re.DOTALL | re.IGNORECASE)
+        match = pattern.search(text_with_tags)
         if match:
             extracted = match.group(1).strip()
-            logger.info(f"[extract_answer_from_tags] Successfully extracted content using pattern: {pattern}")
+            logger.info(f"[extract_answer_from_tags] Successfully extracted content using pattern: {pattern.pattern}")
             logger.info(f"[extract_answer_from_tags] Extracted content: '{extracted}'")
             logger.info(f"[extract_answer_from_tags] Extracted content length: {len(extracted)}")
-            logger.debug(f"Successfully extracted content using pattern: {pattern}")
+            logger.debug(f"Successfully extracted content using pattern: {pattern.pattern}")
             return extracted
     
     logger.warning(f"Could not find <{tag_name}> tags in the provided text. Returning raw text.")
     logger.debug(f"Text preview that failed tag extraction (first 100 chars): {text_with_tags[:100]}...")
     return text_with_tags # Return raw text if tags not found, as per original logic
 
+# Constant error bodies, encoded once: these paths are hit repeatedly when an upstream is flapping or a
+# client retries too fast. Same {"detail": ...} shape FastAPI produces for HTTPException.
+_ERR_COOLDOWN = orjson.dumps({"detail": "Please wait a moment before starting another interview. Try again in a few seconds."})
+_ERR_VOICE_UNAVAILABLE = orjson.dumps({"detail": "Service temporarily unavailable: Voice AI service not ready."})
+_ERR_AI2_UNAVAILABLE = orjson.dumps({"detail": "AI#2 service unavailable (key missing at call time)."})
+_ERR_AI3_UNAVAILABLE = orjson.dumps({"detail": "AI#3 service unavailable (config missing at call time)."})
+
+def _error_response(body: bytes, status_code: int) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
 # --- API Endpoints (Content mostly unchanged, ensuring use of global API key VALUES) ---
 @app.get("/health", summary="Health check endpoint")
 async def health_check(): 
@@ -489,53 +643,49 @@ async def health_check():
     return {"status": "ok", "message": "AI Medical Intake Backend is running."}
 
 @app.post("/api/v1/initiate-intake", summary="Initiate Ultravox Medical Intake Call")
-async def initiate_intake_call():
+async def initiate_intake_call(request: Request):
     logger.critical("########## /api/v1/initiate-intake endpoint CALLED ##########")
     
-    # QUICK FIX: Simple cooldown to prevent 4409 conflicts
-    import time
-    current_time = time.time()
-    
-    # Clean old entries (older than 60 seconds) periodically
-    if current_time % 100 == 0:  # Clean every ~100 calls
-        call_cooldown.clear()
-    
-    # Check cooldown - prevent calls within 5 seconds
-    last_call_time = call_cooldown.get("last_call", 0)
-    if current_time - last_call_time < 5:
-        logger.warning(f"Call attempted too soon. Last call: {last_call_time}, Current: {current_time}")
-        raise HTTPException(
-            status_code=429, 
-            detail="Please wait a moment before starting another interview. Try again in a few seconds."
-        )
-    
     if not ULTRAVOX_API_KEY_VALUE:
         logger.error("Ultravox API Key is not available at time of call to /initiate-intake.")
-        raise HTTPException(status_code=503, detail="Service temporarily unavailable: Voice AI service not ready.")
+        return _error_response(_ERR_VOICE_UNAVAILABLE, 503)
+
+    # QUICK FIX: Per-caller rate limit to prevent 4409 conflicts.
+    # Key on the last X-Forwarded-For hop: Cloud Run's front end appends the address it saw, everything
+    # to its left is whatever the client sent. request.client is that front end, not the caller.
+    forwarded_for = request.headers.get("x-forwarded-for")
+    client_host = forwarded_for.rpartition(",")[2].strip() if forwarded_for else ""
+    if not client_host: # Local runs, no proxy in front
+        client_host = request.client.host if request.client else "unknown"
+    now = time.monotonic()
+    bucket = call_buckets.get(client_host)
+    if bucket is None:
+        bucket = TokenBucket(CALL_RATE_PER_SECOND, CALL_BURST, now)
+    allowed = bucket.acquire(now)
+    call_buckets[client_host] = bucket # Re-insert to refresh the bucket's TTL while it's in use
+    if not allowed:
+        logger.warning("Call attempted too soon from %s.", client_host)
+        return _error_response(_ERR_COOLDOWN, 429)
 
     agent_call_url = f"{ULTRAVOX_API_BASE_URL}/agents/{ULTRAVOX_AGENT_ID}/calls"
-    # Header X-API-Key value will be redacted by SecureFormatter if logged by requests/http client
+    # Header X-API-Key value will be redacted by RedactFilter if logged by the http client
     headers = {"Content-Type": "application/json", "X-API-Key": ULTRAVOX_API_KEY_VALUE}
     payload_data = {} 
-    logger.info(f"Initiating Ultravox call for agent {ULTRAVOX_AGENT_ID}")
+    logger.info("Initiating Ultravox call for agent %s", ULTRAVOX_AGENT_ID)
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, lambda: requests.post(agent_call_url, headers=headers, json=payload_data, timeout=20))
+        response = await app.state.http.post(agent_call_url, headers=headers, content=orjson.dumps(payload_data), timeout=20)
         response.raise_for_status()
-        call_details = response.json()
+        call_details = orjson.loads(response.content)
         join_url, call_id = call_details.get("joinUrl"), call_details.get("callId")
         if not join_url:
-            logger.error(f"joinUrl not found in Ultravox response: {call_details}")
+            logger.error("joinUrl not found in Ultravox response: %s", call_details)
             raise HTTPException(status_code=502, detail="Failed to get joinUrl from voice AI service.")
         
-        # Record successful call creation
-        call_cooldown["last_call"] = current_time
-        logger.info(f"Ultravox call initiated successfully. Call ID: {call_id}")
+        logger.info("Ultravox call initiated successfully. Call ID: %s", call_id)
         
         # Create response with cache-control headers to prevent any caching
-        from fastapi import Response
         response = Response(
-            content=json.dumps({"joinUrl": join_url, "callId": call_id}),
+            content=orjson.dumps({"joinUrl": join_url, "callId": call_id}),
             media_type="application/json",
             headers={
                 "Cache-Control": "no-store, no-cache, must-revalidate, private",
@@ -544,78 +694,111 @@ async def initiate_intake_call():
             }
         )
         return response
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error calling Ultravox API to initiate call: {e}", exc_info=True)
+    # No call was created on any of these paths, so the caller shouldn't have to wait out the cooldown.
+    except HTTPException:
+        bucket.refund()
+        raise
+    except httpx.HTTPError as e:
+        bucket.refund()
+        logger.error("Error calling Ultravox API to initiate call: %s", e, exc_info=True)
         raise HTTPException(status_code=502, detail=f"Error contacting voice AI service: {str(e)[:200]}...")
     except Exception as e:
-        logger.error(f"Unexpected error during intake initiation: {e}", exc_info=True)
+        bucket.refund()
+        logger.error("Unexpected error during intake initiation: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error during intake initiation.")
 
+# Transcripts shorter than this (after stripping) are silence/no-speech artifacts: nothing for AI #2/#3 to work on.
+MIN_TRANSCRIPT_CHARS = 40
+
+class SubmitTranscriptRequest(msgspec.Struct, frozen=True):
+    """Body of POST /api/v1/submit-transcript. Unknown fields are ignored."""
+    transcript: str | None = None
+    callId: str | None = "N/A"
+
 @app.post("/api/v1/submit-transcript", summary="Submit conversation transcript for processing")
-async def submit_transcript(data: dict = Body(...)):
+async def submit_transcript(request: Request):
     logger.critical("########## /api/v1/submit-transcript endpoint CALLED ##########")
-    transcript_text = data.get("transcript")
-    call_id = data.get("callId", "N/A")
+    try:
+        data = msgspec.json.decode(await request.body(), type=SubmitTranscriptRequest)
+    except msgspec.DecodeError as e: # Also covers msgspec.ValidationError
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {e}")
+    transcript_text = data.transcript
+    call_id = data.callId
 
     if not transcript_text: raise HTTPException(status_code=400, detail="Missing transcript data.")
-    if not GEMINI_API_KEY_VALUE: raise HTTPException(status_code=503, detail="AI#2 service unavailable (key missing at call time).")
-    if not HF_API_TOKEN_VALUE or not AI3_HF_ENDPOINT_URL_VALUE: raise HTTPException(status_code=503, detail="AI#3 service unavailable (config missing at call time).")
-
-    logger.info(f"Received transcript for callId {call_id}. Length: {len(transcript_text)} chars.")
+    if len(transcript_text.strip()) < MIN_TRANSCRIPT_CHARS:
+        # Skip both model calls (seconds of latency and API spend) for an effectively empty interview.
+        logger.info("Transcript for callId %s too short for analysis; skipping AI #2/#3.", call_id)
+        return ORJSONResponse(status_code=200, content={
+            "message": "Transcript too short for analysis.",
+            "summary": None, "analysis": None
+        })
+    if not GEMINI_API_KEY_VALUE: return _error_response(_ERR_AI2_UNAVAILABLE, 503)
+    if call_hf_inference_api is None: return _error_response(_ERR_AI3_UNAVAILABLE, 503)
+
+    logger.info("Received transcript for callId %s. Length: %d chars.", call_id, len(transcript_text))
     
     # Log first 200 chars of transcript for debugging
-    logger.info(f"Transcript preview: {transcript_text[:200]}...")
+    logger.info("Transcript preview: %s...", transcript_text[:200])
     
+    # Open the AI #3 connection while AI #2 is generating, so the HF call later reuses a pooled
+    # connection instead of paying the TCP/TLS handshake on the critical path.
+    hf_warmup = asyncio.create_task(_warm_hf_connection(app.state.http, AI3_HF_ENDPOINT_URL))
     try:
-        ai2_full_prompt = (
-            f"{AI2_SUMMARIZATION_SYSTEM_PROMPT}\n\n"
-            f"Transcript:\n{transcript_text}\n\n"
-            "IMPORTANT REMINDER: Your entire response MUST be a single, valid JSON object. "
-            "Do not include any other text, explanations, or markdown formatting like ```json ... ```. "
-            "Only the raw JSON object is permitted."
-        )
-        logger.info(f"Calling AI #2 (Gemini model: {AI2_GEMINI_MODEL_NAME}) for Summarization...")
+        # Gemini takes the prompt as a single JSON string field, so one join of the precomputed
+        # prefix/suffix around the transcript is the only copy made here.
+        ai2_full_prompt = "".join((_ai2_prompt_prefix(), transcript_text, _AI2_PROMPT_SUFFIX))
+        logger.info("Calling AI #2 (Gemini model: %s) for Summarization...", AI2_GEMINI_MODEL_NAME)
         ai2_response_str = await call_gemini_api(
             model_name=AI2_GEMINI_MODEL_NAME, 
             prompt=ai2_full_prompt
         )
         logger.info("AI #2 (Gemini) response received.")
         try:
-            cleaned_ai2_response_str = re.sub(r'^```json\s*|\s*```$', '', ai2_response_str.strip(), flags=re.MULTILINE | re.DOTALL).strip()
-            summary_json_object = json.loads(cleaned_ai2_response_str)
+            cleaned_ai2_response_str = ai2_response_str.strip()
+            # Usually the model obeys and returns a bare object; only run the fence regex (and its copy) when fenced.
+            if cleaned_ai2_response_str.startswith("```"):
+                cleaned_ai2_response_str = _JSON_FENCE_RE.sub('', cleaned_ai2_response_str).strip()
+            summary_json_object = orjson.loads(cleaned_ai2_response_str)
             logger.info("AI #2 response successfully parsed as JSON.")
-        except json.JSONDecodeError as je:
-            logger.error(f"Failed to parse AI #2 (Gemini) response as JSON. Error: {je}. Response (first 500 chars): '{cleaned_ai2_response_str[:500]}'", exc_info=True)
-            json_match = re.search(r'{.*}', cleaned_ai2_response_str, re.DOTALL) 
-            if json_match:
+        except orjson.JSONDecodeError as je:
+            logger.error("Failed to parse AI #2 (Gemini) response as JSON. Error: %s. Response (first 500 chars): '%s'", je, cleaned_ai2_response_str[:500], exc_info=True)
+            # Outermost {...} block: first '{' to last '}', same span the old greedy '{.*}' regex matched.
+            brace_start = cleaned_ai2_response_str.find('{')
+            brace_end = cleaned_ai2_response_str.rfind('}')
+            if 0 <= brace_start < brace_end:
+                if brace_start == 0 and brace_end == len(cleaned_ai2_response_str) - 1:
+                    # The block is the whole buffer that just failed to parse; retrying would fail identically.
+                    raise HTTPException(status_code=502, detail="Medical summary generation failed: Invalid JSON format from AI#2 after retry.")
                 try:
-                    summary_json_object = json.loads(json_match.group(0))
-                    logger.info("AI #2 response successfully parsed as JSON after regex extraction.")
-                except json.JSONDecodeError as je_retry:
-                    logger.error(f"Still failed to parse AI #2 (Gemini) response as JSON after regex. Error: {je_retry}", exc_info=True)
+                    summary_json_object = orjson.loads(cleaned_ai2_response_str[brace_start:brace_end + 1])
+                    logger.info("AI #2 response successfully parsed as JSON after brace extraction.")
+                except orjson.JSONDecodeError as je_retry:
+                    logger.error("Still failed to parse AI #2 (Gemini) response as JSON after brace extraction. Error: %s", je_retry, exc_info=True)
                     raise HTTPException(status_code=502, detail="Medical summary generation failed: Invalid JSON format from AI#2 after retry.")
             else:
                 raise HTTPException(status_code=502, detail="Medical summary generation failed: No valid JSON found in AI#2 response.")
 
         logger.info("Preparing prompt for AI #3 (Hugging Face Model)...")
-        ai3_prompt = prepare_analysis_prompt(json.dumps(summary_json_object))
+        ai3_prompt = prepare_analysis_prompt(summary_json_object)
         if not ai3_prompt:
             logger.warning("No substantive data for AI #3 analysis.")
-            return JSONResponse(status_code=200, content={
+            return ORJSONResponse(status_code=200, content={
                 "message": "Summary generated. Clinical analysis skipped due to insufficient data.",
                 "summary": summary_json_object, "analysis": None
             })
-        logger.info(f"Calling AI #3 (Hugging Face Endpoint: {AI3_HF_ENDPOINT_URL_VALUE}) for Analysis...")
+        logger.info("Calling AI #3 (Hugging Face Endpoint: %s) for Analysis...", AI3_HF_ENDPOINT_URL)
+        await hf_warmup # Normally finished long ago; never raises
         ai3_raw_response = await call_hf_inference_api(prompt=ai3_prompt)
         logger.info("AI #3 (HF) response received.")
-        logger.debug(f"AI #3 raw response preview (first 200 chars): {ai3_raw_response[:200]}...")
-        logger.info(f"AI #3 full raw response: {ai3_raw_response}")
+        logger.debug("AI #3 raw response preview (first 200 chars): %s...", ai3_raw_response[:200])
+        logger.info("AI #3 full raw response: %s", ai3_raw_response)
         
         clinical_analysis_text = extract_answer_from_tags(ai3_raw_response, tag_name="answer")
         
-        logger.info(f"Extracted clinical analysis text: '{clinical_analysis_text}'")
-        logger.info(f"Clinical analysis length: {len(clinical_analysis_text)}")
-        logger.info(f"Clinical analysis type: {type(clinical_analysis_text)}")
+        logger.info("Extracted clinical analysis text: '%s'", clinical_analysis_text)
+        logger.info("Clinical analysis length: %d", len(clinical_analysis_text))
+        logger.info("Clinical analysis type: %s", type(clinical_analysis_text))
         
         if clinical_analysis_text == ai3_raw_response and not ("<answer>" in ai3_raw_response and "</answer>" in ai3_raw_response) :
              logger.warning("AI #3 (HF) response did not contain <answer> tags as instructed. Using raw response.")
@@ -623,37 +806,37 @@ async def submit_transcript(data: dict = Body(...)):
             logger.info("Successfully extracted/processed clinical analysis from AI #3 (HF).")
         
         final_response = {"message": "Transcript processed successfully.", "summary": summary_json_object, "analysis": clinical_analysis_text}
-        logger.info(f"Final response being sent: {json.dumps(final_response, indent=2)}")
+        if logger.isEnabledFor(logging.INFO): # Skip the pretty-print encode entirely when INFO is off
+            logger.info("Final response being sent: %s", orjson.dumps(final_response, option=orjson.OPT_INDENT_2).decode())
         
         return final_response
     except HTTPException: raise 
     except Exception as e:
-        logger.error(f"Unexpected error processing transcript for callId {call_id}: {e}", exc_info=True)
+        logger.error("Unexpected error processing transcript for callId %s: %s", call_id, e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-
-logger.critical("########## main.py: Reached end of script before Uvicorn or conditional __main__ block. ##########")
+    finally:
+        if not hf_warmup.done(): # Early exit (error, skipped analysis) before the warm-up finished
+            hf_warmup.cancel()
 
 # --- NEW: Helper for local dev env var validation ---
-def validate_local_env_vars(vars_to_check: List[str]) -> List[str]:
-    """Validate that specified environment variables are present for local execution."""
-    missing = []
-    for var_name in vars_to_check:
-        if not os.environ.get(var_name):
-            missing.append(var_name)
-    return missing
+# URLs/IDs will use defaults if not set, which is acceptable for local if intended.
+REQUIRED_ENV_VARS_FOR_LOCAL = frozenset({
+    ULTRAVOX_API_KEY_ENV_VAR,
+    GEMINI_API_KEY_ENV_VAR,
+    HF_API_TOKEN_ENV_VAR,
+})
+
+def validate_local_env_vars(vars_to_check: Iterable[str] = REQUIRED_ENV_VARS_FOR_LOCAL) -> List[str]:
+    """Validate that specified environment variables are present for local execution; returns the missing ones, sorted."""
+    env = os.environ
+    return sorted(var_name for var_name in vars_to_check if not env.get(var_name))
 
 if __name__ == "__main__":
     logger.critical("########## main.py: Running in __main__ block (LOCAL DEVELOPMENT ONLY) ##########")
     
     # --- MODIFIED: No default API keys. Validate presence for local run. ---
     logger.critical("Validating required environment variables for local run...")
-    REQUIRED_ENV_VARS_FOR_LOCAL = [
-        ULTRAVOX_API_KEY_ENV_VAR,
-        GEMINI_API_KEY_ENV_VAR,
-        HF_API_TOKEN_ENV_VAR
-        # URLs/IDs will use defaults if not set, which is acceptable for local if intended.
-    ]
-    missing_vars = validate_local_env_vars(REQUIRED_ENV_VARS_FOR_LOCAL)
+    missing_vars = validate_local_env_vars()
     if missing_vars:
         logger.critical(f"❌ CRITICAL LOCAL STARTUP FAILURE: Missing required environment variables: {missing_vars}")
         logger.critical("   Please set these in your local environment before running.")
@@ -664,13 +847,16 @@ if __name__ == "__main__":
     # Set other defaults if not present (these are less sensitive or have workable defaults)
     os.environ.setdefault("AI3_HF_ENDPOINT_URL", AI3_HF_ENDPOINT_URL_DEFAULT)
     os.environ.setdefault("AI2_GEMINI_MODEL_NAME", AI2_GEMINI_MODEL_NAME_DEFAULT) 
-    os.environ.setdefault("ULTRAVOX_AGENT_ID", "fb42f359-003c-4875-b1a1-06c4c1c87376")
+    os.environ.setdefault("ULTRAVOX_AGENT_ID", ULTRAVOX_AGENT_ID_DEFAULT)
     
     logger.critical("Attempting to run startup_event manually for local __main__ execution...")
     try:
-        async def local_startup_wrapper():
-            await startup_event()
-        asyncio.run(local_startup_wrapper())
+        import uvloop
+        # Same loop implementation uvicorn will use; uvicorn runs startup_event again on its own loop,
+        # so the resources created by this validation run are released right away.
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(startup_event())
+            runner.run(shutdown_event())
         logger.critical("Manual startup_event COMPLETED for local __main__ execution.")
     except Exception as e_startup_local:
         logger.critical(f"CRITICAL ERROR DURING MANUAL LOCAL STARTUP (via __main__): {e_startup_local}", exc_info=True)
@@ -680,7 +866,9 @@ if __name__ == "__main__":
     try:
         import uvicorn
         # Ensure host is 0.0.0.0 for Docker, port 8080 as per Cloud Run expectation
-        uvicorn.run(app, host="0.0.0.0", port=8080, log_level="debug") # Removed loop="asyncio" as uvicorn handles it
+        # libuv-backed event loop and C HTTP parser instead of the pure-Python defaults
+        # info level and no access log: debug/access lines cost a format + redaction scan per request
+        uvicorn.run(app, host="0.0.0.0", port=8080, log_level="info", loop="uvloop", http="httptools", access_log=False)
     except Exception as e_uvicorn:
         logger.critical(f"CRITICAL ERROR trying to run Uvicorn: {e_uvicorn}", exc_info=True)
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,47 @@
+import io
+import logging
+
+import pytest
+
+from main import RedactFilter
+
+redact = RedactFilter().redact
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("Authorization: Bearer hf_SECRET", "Authorization: Bearer [REDACTED_HF_TOKEN]"),
+    ("Authorization: Bearer\thf_SECRET next", "Authorization: Bearer\t[REDACTED_HF_TOKEN] next"),
+    ("Authorization: Bearer abc:def", "Authorization: Bearer [REDACTED_HF_TOKEN]"),
+    ("Authorization: Bearer hf_SECRET : trailing", "Authorization: Bearer [REDACTED_HF_TOKEN] : trailing"),
+    ("Bearer hf_SECRET:", "Bearer [REDACTED_HF_TOKEN]"),
+    ("{'Authorization': 'Bearer hf_SECRET'}", "{'Authorization': 'Bearer [REDACTED_HF_TOKEN]"),
+])
+def test_bearer_token_is_redacted(message, expected):
+    assert redact(message) == expected
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("Bearer X-API-Key: SECRET", "Bearer X-API-Key: [REDACTED_ULTRAVOX_KEY]"),
+    ("Bearer token: SECRET", "Bearer token: [REDACTED_SENSITIVE_VALUE]"),
+    ("Bearer token:SECRET", "Bearer token:[REDACTED_SENSITIVE_VALUE]"),
+])
+def test_label_after_bearer_keeps_its_value_redacted(message, expected):
+    assert redact(message) == expected
+
+
+def test_message_without_triggers_is_unchanged():
+    message = "AI #3 (HF) response received."
+    assert redact(message) is message
+
+
+def test_malformed_log_call_does_not_raise_into_caller(capsys):
+    handler = logging.StreamHandler(io.StringIO())
+    handler.addFilter(RedactFilter())
+    log = logging.getLogger("test_redact_filter.malformed")
+    log.propagate = False
+    log.addHandler(handler)
+    try:
+        log.error("bad %d", "x")
+    finally:
+        log.removeHandler(handler)
+    assert "--- Logging error ---" in capsys.readouterr().err